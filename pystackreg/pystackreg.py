@@ -1,9 +1,118 @@
 # -*- coding: utf-8 -*-
 from . import turboreg  # type: ignore
 import numpy as np
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 import warnings
-from .util import simple_slice, running_mean
+from .util import running_mean
+
+
+def _contiguous_frames_view(img, axis, crop=False):
+    """
+    Return the stack with the time axis moved to the front and C-contiguous
+    frames.
+
+    The turboreg extension operates on row-major (C-order) buffers - despite
+    its ImageJ lineage it is not column-major - and converts non-contiguous
+    input while still holding the GIL, which would serialize the worker
+    threads. Doing the layout conversion once for the whole stack keeps the
+    per-frame calls into the extension copy-free; for a C-contiguous stack
+    with the time axis in front (and no crop) this is a zero-copy view.
+
+    If ``crop`` is set, the last row and column of every frame are dropped
+    before the layout conversion. Registration discards them anyway, and
+    cropping the individual frames instead would make them non-contiguous
+    again, reintroducing a GIL-held copy per extension call.
+    """
+    img_view = np.moveaxis(img, axis, 0)
+
+    if crop:
+        img_view = img_view[:, :-1, :-1]
+
+    return np.ascontiguousarray(img_view)
+
+
+def _short_to_long_translation(m):
+    """
+    Short-to-long matrix conversion for translation transformations.
+    """
+    mat = np.identity(3)
+    mat[0, 2] = m[0, 0]
+    mat[1, 2] = m[1, 0]
+    return mat
+
+
+def _short_to_long_linear(m):
+    """
+    Short-to-long matrix conversion for rigid body, scaled rotation and
+    affine transformations.
+    """
+    mat = np.identity(3)
+    mat[0, 0] = m[0, 1]
+    mat[0, 1] = m[0, 2]
+    mat[0, 2] = m[0, 0]
+    mat[1, 0] = m[1, 1]
+    mat[1, 1] = m[1, 2]
+    mat[1, 2] = m[1, 0]
+    return mat
+
+
+def _short_to_long_bilinear(m):
+    """
+    Short-to-long matrix conversion for bilinear transformations.
+    """
+    mat = np.identity(4)
+    mat[0, 0] = m[0, 1]
+    mat[0, 1] = m[0, 2]
+    mat[0, 2] = m[0, 3]
+    mat[0, 3] = m[0, 0]
+    mat[1, 0] = m[1, 1]
+    mat[1, 1] = m[1, 2]
+    mat[1, 2] = m[1, 3]
+    mat[1, 3] = m[1, 0]
+    return mat
+
+
+def _long_to_short_translation(mat):
+    """
+    Long-to-short matrix conversion for translation transformations.
+    """
+    m = np.empty((2, 1), dtype=np.double)
+    m[0, 0] = mat[0, 2]
+    m[1, 0] = mat[1, 2]
+    return m
+
+
+def _long_to_short_linear(mat):
+    """
+    Long-to-short matrix conversion for rigid body, scaled rotation and
+    affine transformations.
+    """
+    m = np.empty((2, 3), dtype=np.double)
+    m[0, 0] = mat[0, 2]
+    m[0, 1] = mat[0, 0]
+    m[0, 2] = mat[0, 1]
+    m[1, 0] = mat[1, 2]
+    m[1, 1] = mat[1, 0]
+    m[1, 2] = mat[1, 1]
+    return m
+
+
+def _long_to_short_bilinear(mat):
+    """
+    Long-to-short matrix conversion for bilinear transformations.
+    """
+    m = np.empty((2, 4), dtype=np.double)
+    m[0, 0] = mat[0, 3]
+    m[0, 1] = mat[0, 0]
+    m[0, 2] = mat[0, 1]
+    m[0, 3] = mat[0, 2]
+    m[1, 0] = mat[1, 3]
+    m[1, 1] = mat[1, 0]
+    m[1, 2] = mat[1, 1]
+    m[1, 3] = mat[1, 2]
+    return m
 
 
 class StackReg:
@@ -57,6 +166,19 @@ class StackReg:
             raise Exception("Invalid transformation")
 
         self._transformation = transformation
+
+        # bind the matrix conversion functions specialized for the chosen
+        # transformation once, instead of branching on every conversion
+        if transformation == self.TRANSLATION:
+            self._short_to_long = _short_to_long_translation
+            self._long_to_short = _long_to_short_translation
+        elif transformation == self.BILINEAR:
+            self._short_to_long = _short_to_long_bilinear
+            self._long_to_short = _long_to_short_bilinear
+        else:
+            self._short_to_long = _short_to_long_linear
+            self._long_to_short = _long_to_short_linear
+
         self._m = None
         self._tmats = None
         self._refpts = None
@@ -180,24 +302,7 @@ class StackReg:
         :rtype:  ndarray(3,3)
         :return: Canonical transformation matrix
         """
-
-        if self._transformation == self.TRANSLATION:
-            mat = np.identity(3).astype(np.double)
-            mat[0:2, 2] = m[:, 0]
-        elif self._transformation in [
-            self.RIGID_BODY,
-            self.SCALED_ROTATION,
-            self.AFFINE,
-        ]:
-            mat = np.identity(3).astype(np.double)
-            mat[0:2, :] = m[:, [1, 2, 0]]
-        elif self._transformation == self.BILINEAR:
-            mat = np.identity(4).astype(np.double)
-            mat[0:2, :] = m[:, [1, 2, 3, 0]]
-        else:
-            raise Exception("Unexpected transformation")
-
-        return mat
+        return self._short_to_long(m)
 
     def _matrix_long_to_short(self, mat):
         """
@@ -210,20 +315,86 @@ class StackReg:
         :rtype:  array_like
         :return: TurboReg transformation matrix
         """
+        return self._long_to_short(mat)
+
+    def _matrix_short_to_long_batch(self, ms):
+        """
+        Converts a stack of transformation matrices from the short form used
+        by TurboReg to the canonical form from linear algebra with a single
+        vectorized operation instead of one conversion per frame.
+
+        :type ms: ndarray(N,2,1), ndarray(N,2,3) or ndarray(N,2,4)
+        :param ms: Stack of TurboReg transformation matrices
+
+        :rtype:  ndarray(N,3,3) or ndarray(N,4,4) for bilinear transformation
+        :return: Stack of canonical transformation matrices
+        """
+        tmatdim = 4 if self._transformation == self.BILINEAR else 3
+
+        mats = np.zeros((ms.shape[0], tmatdim, tmatdim), dtype=np.double)
+        mats[:] = np.identity(tmatdim)
+
         if self._transformation == self.TRANSLATION:
-            m = mat[0:2, 2].reshape((2, 1))
-        elif self._transformation in [
-            self.RIGID_BODY,
-            self.SCALED_ROTATION,
-            self.AFFINE,
-        ]:
-            m = mat[0:2, [2, 0, 1]]
+            mats[:, 0:2, 2] = ms[:, :, 0]
         elif self._transformation == self.BILINEAR:
-            m = mat[0:2, [3, 0, 1, 2]]
+            mats[:, 0:2, :] = ms[:, :, [1, 2, 3, 0]]
         else:
-            raise Exception("Unexpected transformation")
+            mats[:, 0:2, :] = ms[:, :, [1, 2, 0]]
+
+        return mats
+
+    def _matrix_long_to_short_batch(self, tmats):
+        """
+        Converts a stack of transformation matrices from the canonical form
+        from linear algebra to the short form used by TurboReg with a single
+        vectorized operation instead of one conversion per frame.
 
-        return m.astype(np.double)
+        :type tmats: ndarray(N,3,3) or ndarray(N,4,4) for bilinear transformation
+        :param tmats: Stack of canonical transformation matrices
+
+        :rtype:  ndarray
+        :return: Stack of TurboReg transformation matrices
+        """
+        if self._transformation == self.TRANSLATION:
+            m = tmats[:, 0:2, 2].reshape((-1, 2, 1))
+        elif self._transformation == self.BILINEAR:
+            m = tmats[:, 0:2][:, :, [3, 0, 1, 2]]
+        else:
+            m = tmats[:, 0:2][:, :, [2, 0, 1]]
+
+        return np.ascontiguousarray(m, dtype=np.double)
+
+    @staticmethod
+    def _detect_similar_frames(img_view, threshold, downsample):
+        """
+        Detect frames that are nearly identical to their preceding frame.
+
+        The similarity score is the mean absolute difference between
+        consecutive frames after coarse downsampling by strided slicing,
+        which is cheap compared to a registration.
+
+        :type img_view: array_like(N, Ni..., Nj...)
+        :param img_view: The image stack with the time axis moved to the front
+
+        :type threshold: float
+        :param threshold: Frames with a score below this value are considered
+                          similar to their predecessor
+
+        :type downsample: int
+        :param downsample: Approximate edge length of the downsampled frames
+                           used for the comparison
+
+        :rtype:  ndarray(N) of bool
+        :return: True for every frame that is nearly identical to its
+                 predecessor; the first frame is always False
+        """
+        step_i = max(1, img_view.shape[1] // downsample)
+        step_j = max(1, img_view.shape[2] // downsample)
+
+        small = img_view[:, ::step_i, ::step_j].astype(np.double)
+        score = np.abs(np.diff(small, axis=0)).mean(axis=(1, 2))
+
+        return np.concatenate(([False], score < threshold))
 
     @staticmethod
     def _detect_time_axis(img):
@@ -248,6 +419,199 @@ class StackReg:
         """
         return self._refpts, self._movpts
 
+    def _run_registrations(self, jobs, verbose, progress_callback, ref_handle=None):
+        """
+        Run a set of independent frame registrations concurrently.
+
+        The C extension releases the GIL during registration, so the
+        registrations are dispatched to a thread pool. The resulting
+        transformation matrices are stored in long form in ``self._tmats``.
+
+        :type jobs: list of (int, ndarray, ndarray)
+        :param jobs: List of (frame index, reference image, moving image)
+                     tuples; the images must already be cropped to the
+                     registration region (i.e. without the last row/column)
+
+        :type verbose: bool
+        :param verbose: Specifies whether a progressbar should be shown using tqdm.
+
+        :type progress_callback: function
+        :param progress_callback:
+            A function that is called after every iteration. This function should accept
+            the keyword arguments current_iteration:int and end_iteration:int.
+
+        :type ref_handle: capsule, optional
+        :param ref_handle:
+            Prepared reference image from turboreg._prepare_ref; if given, the
+            reference entries of the jobs are ignored and all frames are
+            registered against the prepared reference
+        """
+        # hoist the hot lookups out of the per-frame loops - for small frames
+        # the Python dispatch overhead is a measurable fraction of a
+        # registration
+        register = turboreg._register
+        register_prepared = turboreg._register_prepared
+        transformation = self._transformation
+
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+            submit = pool.submit
+            if ref_handle is not None:
+                futures = [
+                    (i, submit(register_prepared, ref_handle, mov))
+                    for i, ref, mov in jobs
+                ]
+            else:
+                futures = [
+                    (i, submit(register, ref, mov, transformation))
+                    for i, ref, mov in jobs
+                ]
+
+            iterable = as_completed([future for i, future in futures])
+
+            if verbose:
+                # limit the refresh frequency - per-iteration updates show up
+                # in profiles when the individual registrations are fast
+                iterable = tqdm(
+                    iterable,
+                    total=len(futures),
+                    miniters=max(1, len(futures) // 100),
+                    mininterval=0.5,
+                )
+
+            for n, future in enumerate(iterable):
+                if progress_callback is not None:
+                    progress_callback(
+                        current_iteration=n + 1, end_iteration=len(futures)
+                    )
+
+        results = [future.result() for i, future in futures]
+
+        if results:
+            self._m, self._refpts, self._movpts = results[-1]
+
+            # convert all short matrices to long form in one vectorized
+            # operation instead of one conversion per frame
+            indices = [i for i, future in futures]
+            shorts = np.stack([m for m, refpts, movpts in results])
+            self._tmats[indices] = self._matrix_short_to_long_batch(shorts)
+
+        self._is_registered = True
+
+    def _register_stack_to_reference(
+        self, img, ref, idx_start, axis, verbose, progress_callback, skip=None
+    ):
+        """
+        Register every frame of a stack to a fixed reference image.
+
+        The per-frame registrations are independent of each other and are
+        carried out concurrently.
+
+        :type img: array_like(Ni..., Nj..., Nk...)
+        :param img: The 3D stack of images that should be aligned
+
+        :type ref: array_like (Ni..., Nj...)
+        :param ref: Reference image (static)
+
+        :type idx_start: int
+        :param idx_start: Index of the first frame to register
+
+        :type axis: int
+        :param axis: The axis of the time dimension
+
+        :type verbose: bool
+        :param verbose: Specifies whether a progressbar should be shown using tqdm.
+
+        :type progress_callback: function
+        :param progress_callback:
+            A function that is called after every iteration. This function should accept
+            the keyword arguments current_iteration:int and end_iteration:int.
+
+        :type skip: ndarray of bool, optional
+        :param skip: Frames for which the transformation of the preceding
+                     frame is reused instead of registering
+        """
+        img_view = _contiguous_frames_view(img, axis, crop=True)
+
+        # compute the pyramid of the (fixed) reference image once instead of
+        # once per frame
+        ref_handle = turboreg._prepare_ref(ref[:-1, :-1], self._transformation)
+
+        jobs = [
+            (i, None, img_view[i])
+            for i in range(idx_start, img.shape[axis])
+            if skip is None or not skip[i]
+        ]
+
+        self._run_registrations(jobs, verbose, progress_callback, ref_handle)
+
+        if skip is not None:
+            # propagate in ascending order so that runs of similar frames all
+            # inherit the matrix of the last registered frame
+            for i in range(idx_start, img.shape[axis]):
+                if skip[i]:
+                    self._tmats[i, :, :] = self._tmats[i - 1, :, :]
+
+    def _register_stack_to_previous(
+        self, img, idx_start, axis, verbose, progress_callback, skip=None
+    ):
+        """
+        Register every frame of a stack to its previous frame.
+
+        The pairwise frame-to-frame registrations are independent of each
+        other and are carried out concurrently; only the accumulation of the
+        pairwise matrices into transformations relative to the first frame
+        is order dependent. As matrix multiplication is associative, the
+        accumulation is done afterwards as an inclusive prefix scan by
+        repeated doubling, i.e. O(log N) batched matrix products instead of
+        N serial ones.
+
+        :type img: array_like(Ni..., Nj..., Nk...)
+        :param img: The 3D stack of images that should be aligned
+
+        :type idx_start: int
+        :param idx_start: Index of the first frame to register
+
+        :type axis: int
+        :param axis: The axis of the time dimension
+
+        :type verbose: bool
+        :param verbose: Specifies whether a progressbar should be shown using tqdm.
+
+        :type progress_callback: function
+        :param progress_callback:
+            A function that is called after every iteration. This function should accept
+            the keyword arguments current_iteration:int and end_iteration:int.
+
+        :type skip: ndarray of bool, optional
+        :param skip: Frames for which the pairwise transformation to the
+                     preceding frame is assumed to be the identity
+        """
+        img_view = _contiguous_frames_view(img, axis, crop=True)
+
+        # the reference frame is a zero-copy view as well - img.take would
+        # copy a full frame per registration
+        jobs = [
+            (i, img_view[i - 1], img_view[i])
+            for i in range(idx_start, img.shape[axis])
+            if skip is None or not skip[i]
+        ]
+
+        self._run_registrations(jobs, verbose, progress_callback)
+
+        # scratch buffer for the scan steps - np.matmul cannot write into
+        # memory that overlaps its operands, and computing into a reused
+        # buffer avoids one temporary allocation per doubling step
+        buf = np.empty_like(self._tmats)
+
+        n = self._tmats.shape[0]
+        stride = 1
+        while stride < n:
+            np.matmul(
+                self._tmats[stride:], self._tmats[:-stride], out=buf[: n - stride]
+            )
+            self._tmats[stride:] = buf[: n - stride]
+            stride *= 2
+
     def register_stack(
         self,
         img,
@@ -258,6 +622,8 @@ class StackReg:
         verbose=False,
         progress_callback=None,
         suppress_axis_warning=False,
+        similarity_threshold=None,
+        similarity_downsample=32,
     ):
         """
         Register a stack of images (movie).
@@ -307,6 +673,21 @@ class StackReg:
             warning when the detected time axis is not equal to the supplied axis.
             Set this option to True to suppress this warning.
 
+        :type similarity_threshold: float, optional
+        :param similarity_threshold:
+            If set, frames that are nearly identical to their preceding frame
+            (mean absolute difference of coarsely downsampled frames below
+            this threshold) are not registered; they reuse the transformation
+            of the preceding frame instead. Useful together with
+            moving_average, where consecutive smoothed frames are highly
+            correlated. Disabled by default.
+
+        :type similarity_downsample: int, optional
+        :param similarity_downsample:
+            Approximate edge length of the downsampled frames used for the
+            similarity comparison (only relevant if similarity_threshold is
+            set).
+
         :rtype:  ndarray(img.shape[axis], 3, 3)
         :return: The transformation matrix for each image in the stack
         """
@@ -343,9 +724,10 @@ class StackReg:
 
         tmatdim = 4 if self._transformation == self.BILINEAR else 3
 
-        self._tmats = np.repeat(
-            np.identity(tmatdim).reshape((1, tmatdim, tmatdim)), img.shape[axis], axis=0
-        ).astype(np.double)
+        # single allocation in the final dtype plus one broadcast write -
+        # cheaper than materializing repeated identity matrices and casting
+        self._tmats = np.zeros((img.shape[axis], tmatdim, tmatdim), dtype=np.double)
+        self._tmats[:] = np.identity(tmatdim)
 
         if reference == "first":
             ref = np.mean(img.take(range(n_frames), axis=axis), axis=axis)
@@ -357,35 +739,75 @@ class StackReg:
         else:
             raise ValueError('Unknown reference "{}"'.format(reference))
 
-        iterable = range(idx_start, img.shape[axis])
+        skip = None
+        if similarity_threshold is not None:
+            skip = self._detect_similar_frames(
+                np.moveaxis(img, axis, 0), similarity_threshold, similarity_downsample
+            )
 
-        if verbose:
-            iterable = tqdm(iterable)
+        if reference == "previous":
+            self._register_stack_to_previous(
+                img, idx_start, axis, verbose, progress_callback, skip
+            )
+        else:
+            self._register_stack_to_reference(
+                img, ref, idx_start, axis, verbose, progress_callback, skip
+            )
 
-        for i in iterable:
+        return self._tmats
 
-            slc = [slice(None)] * len(img.shape)
-            slc[axis] = i
+    def _transform_stack_cuda(self, img_view, out_view, tmats_short):
+        """
+        Transform a stack on the GPU using CuPy.
 
-            if reference == "previous":
-                ref = img.take(i - 1, axis=axis)
+        The stack is uploaded once, each frame is warped with
+        cupyx.scipy.ndimage.affine_transform using the same output-to-source
+        mapping and cubic spline interpolation as the CPU path, and the
+        result is written back into the preallocated output. Border handling
+        of the spline prefilter may differ marginally from TurboReg.
 
-            self._tmats[i, :, :] = self.register(ref, simple_slice(img, i, axis))
+        :type img_view: array_like(N, Ni..., Nj...)
+        :param img_view: The image stack with the time axis moved to the front
 
-            if reference == "previous" and i > 0:
-                self._tmats[i, :, :] = np.matmul(
-                    self._tmats[i, :, :], self._tmats[i - 1, :, :]
-                )
+        :type out_view: ndarray(N, Ni..., Nj...)
+        :param out_view: Output stack with the time axis moved to the front
 
-            if progress_callback is not None:
-                progress_callback(
-                    current_iteration=i - idx_start + 1,
-                    end_iteration=img.shape[axis] - idx_start,
-                )
+        :type tmats_short: ndarray(N, 2, 3)
+        :param tmats_short: The short-form transformation matrices
+        """
+        if self._transformation == self.BILINEAR:
+            raise Exception(
+                "Bilinear transformations are not supported on the CUDA "
+                'backend. Use backend="cpu" instead.'
+            )
 
-        return self._tmats
+        try:
+            import cupy as cp
+            from cupyx.scipy import ndimage as cupy_ndimage
+        except ImportError:
+            raise ImportError(
+                'transform_stack with backend="cuda" requires the optional '
+                "dependency CuPy (https://cupy.dev)"
+            )
 
-    def transform_stack(self, img, axis=0, tmats=None):
+        img_gpu = cp.asarray(img_view, dtype=cp.float64)
+
+        for i in range(img_view.shape[0]):
+            m = self._matrix_short_to_long(tmats_short[i])
+
+            # turboreg maps output (col, row) to source coordinates as
+            # col' = m[0, 2] + m[0, 0] * col + m[0, 1] * row (rows likewise);
+            # affine_transform expects the same mapping in (row, col) order
+            matrix = cp.asarray([[m[1, 1], m[1, 0]], [m[0, 1], m[0, 0]]])
+            offset = cp.asarray([m[1, 2], m[0, 2]])
+
+            out_view[i] = cp.asnumpy(
+                cupy_ndimage.affine_transform(
+                    img_gpu[i], matrix, offset=offset, order=3, mode="constant"
+                )
+            )
+
+    def transform_stack(self, img, axis=0, tmats=None, backend="cpu"):
         """
         Transform a stack after registration.
 
@@ -398,9 +820,19 @@ class StackReg:
         :type tmats: ndarray(img.shape[axis], 3, 3), optional
         :param tmats: The transformation matrix for each image in the stack
 
+        :type backend: string, one of ['cpu', 'cuda'], optional
+        :param backend:
+            *  *'cpu'*: Transform the frames with the turboreg extension,
+               parallelized over CPU cores
+            *  *'cuda'*: Transform the frames on the GPU (requires the
+               optional dependency CuPy; not available for bilinear
+               transformations)
+
         :rtype:  ndarray(Ni..., Nj..., Nk...)
         :return: The transformed stack
         """
+        if backend not in ("cpu", "cuda"):
+            raise ValueError('Unknown backend "{}"'.format(backend))
         if tmats is None:
             if self._tmats is None:
                 raise Exception(
@@ -408,18 +840,50 @@ class StackReg:
                     "transformation matrices explicitly."
                 )
             tmats = self._tmats
+        else:
+            # normalize dtype and layout once for the whole stack instead of
+            # paying a per-frame conversion inside the extension
+            tmats = np.ascontiguousarray(tmats, dtype=np.float64)
 
         if tmats.shape[0] != img.shape[axis]:
             raise Exception(
                 "Number of saved transformation matrices does not match stack length"
             )
 
-        out = img.copy().astype(float)
-
-        for i in range(img.shape[axis]):
-            slc = [slice(None)] * len(out.shape)
-            slc[axis] = i
-            out[tuple(slc)] = self.transform(simple_slice(img, i, axis), tmats[i, :, :])
+        # convert the whole stack in one vectorized operation instead of one
+        # long-to-short conversion per frame
+        tmats_short = self._matrix_long_to_short_batch(tmats)
+
+        # every slice of the output is overwritten below, so there is no need
+        # to seed it with a (costly) copy of the input stack; single precision
+        # input stays single precision - for large stacks this halves the
+        # memory footprint of the output while the warp itself still runs in
+        # double precision inside the extension
+        out_dtype = np.float32 if img.dtype == np.float32 else np.float64
+        out = np.empty(img.shape, dtype=out_dtype)
+
+        # the per-frame transformations are independent of each other and the
+        # C extension releases the GIL, so the frames can be transformed
+        # concurrently
+        img_view = _contiguous_frames_view(img, axis)
+        out_view = np.moveaxis(out, axis, 0)
+
+        if backend == "cuda":
+            self._transform_stack_cuda(img_view, out_view, tmats_short)
+            return out
+
+        # each worker writes its own (disjoint) output slice directly, so only
+        # the frames currently in flight are alive in addition to the output
+        # stack - collecting the results through the futures would keep a
+        # second full float64 stack around
+        def transform_frame(i):
+            out_view[i] = turboreg._transform(img_view[i], tmats_short[i])
+
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+            futures = [pool.submit(transform_frame, i) for i in range(img.shape[axis])]
+
+        for future in futures:
+            future.result()
 
         return out
 
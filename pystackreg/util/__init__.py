@@ -3,6 +3,11 @@ Collection of utility functions for pystackreg
 """
 import numpy as np
 
+try:
+    from scipy.ndimage import uniform_filter1d
+except ImportError:
+    uniform_filter1d = None
+
 
 def to_uint16(arr):
     """
@@ -100,7 +105,17 @@ def running_mean(x, N, axis=0):
     :rtype:  ndarray(Ni..., Nj..., Nk...)
     :return: The returned array has the same shape and type as x
     """
+    x = np.asarray(x, dtype=np.double)
+
+    if uniform_filter1d is not None:
+        # single pass with a sliding-window accumulator implemented in C -
+        # avoids allocating a full-size cumulative sum temporary and is
+        # numerically more stable than a cumulative sum for large N
+        return uniform_filter1d(x, size=N, axis=axis, mode="nearest", origin=N % 2 - 1)
+
     pad_width = [[0, 0]] * len(x.shape)
     pad_width[axis] = [int(np.ceil(N / 2)), int(np.floor(N / 2))]
     cumsum = np.cumsum(np.pad(x, pad_width, "edge"), axis=axis)
-    return (cumsum[N:] - cumsum[:-N]) / float(N)
+    upper = simple_slice(cumsum, slice(N, None), axis)
+    lower = simple_slice(cumsum, slice(None, -N), axis)
+    return (upper - lower) / float(N)
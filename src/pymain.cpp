@@ -30,8 +30,22 @@ typedef struct regMat {
   matrix<double> movPts;
 } regMat;
 
+/* Reference image with precomputed pyramid that can be reused across
+ * several registrations against the same reference. */
+typedef struct preparedRef {
+  TurboRegImage *refImg;
+  TurboRegMask *refMsk;
+  Transformation transformation;
+  int width;
+  int height;
+} preparedRef;
+
+static const char *PREPARED_REF_CAPSULE_NAME = "pystackreg.turboreg._prepared_ref";
+
 static PyObject *turbogreg_register(PyObject *self, PyObject *args);
 static PyObject *turbogreg_transform(PyObject *self, PyObject *args);
+static PyObject *turbogreg_prepare_ref(PyObject *self, PyObject *args);
+static PyObject *turbogreg_register_prepared(PyObject *self, PyObject *args);
 
 static char pystackreg_docs[] = "PyStackReg\n";
 static PyMethodDef module_methods[] = {
@@ -39,6 +53,10 @@ static PyMethodDef module_methods[] = {
      pystackreg_docs},
     {"_transform", (PyCFunction)turbogreg_transform, METH_VARARGS,
      pystackreg_docs},
+    {"_prepare_ref", (PyCFunction)turbogreg_prepare_ref, METH_VARARGS,
+     pystackreg_docs},
+    {"_register_prepared", (PyCFunction)turbogreg_register_prepared,
+     METH_VARARGS, pystackreg_docs},
     {NULL}};
 
 #ifdef ISPY3
@@ -104,6 +122,38 @@ bool registerImg(double *pDataRef, double *pDataMov,
   return true;
 }
 
+bool registerImgPrepared(preparedRef *prep, double *pDataMov, regMat &rm) {
+  TurboRegImage movImg(pDataMov, prep->width, prep->height,
+                       prep->transformation, false);
+
+  /* the point handlers and the moving image are per-registration state;
+   * only the (read-only) reference image and mask are shared */
+  TurboRegPointHandler refPH(*prep->refImg, prep->transformation);
+  TurboRegPointHandler movPH(movImg, prep->transformation);
+
+  TurboRegMask movMsk(movImg);
+
+  movMsk.clearMask();
+
+  int pyramidDepth = prep->refImg->getPyramidDepth();
+  movImg.setPyramidDepth(pyramidDepth);
+  movMsk.setPyramidDepth(pyramidDepth);
+
+  movImg.init();
+  movMsk.init();
+
+  TurboRegTransform tform(&movImg, &movMsk, &movPH, prep->refImg, prep->refMsk,
+                          &refPH, prep->transformation, false);
+
+  tform.doRegistration();
+
+  rm.mat = tform.getTransformationMatrix();
+  rm.refPts = refPH.getPoints();
+  rm.movPts = movPH.getPoints();
+
+  return true;
+}
+
 std::vector<double> transformImg(matrix<double> m, double *pDataMov, int width,
                                  int height) {
   Transformation transformation = getTransformationFromMatrix(m);
@@ -130,6 +180,153 @@ std::vector<double> transformImg(matrix<double> m, double *pDataMov, int width,
   return imgout;
 }
 
+static PyObject *regMatToPyTuple(regMat &rm) {
+  npy_intp dims_mat[2];
+  npy_intp dims_pts[2];
+
+  dims_mat[0] = rm.mat.nrows();
+  dims_mat[1] = rm.mat.ncols();
+  dims_pts[0] = rm.refPts.nrows();
+  dims_pts[1] = rm.refPts.ncols();
+
+  PyObject *retMat = PyArray_SimpleNew(2, (npy_intp *)&dims_mat, NPY_DOUBLE);
+  PyObject *retPtsRef = PyArray_SimpleNew(2, (npy_intp *)&dims_pts, NPY_DOUBLE);
+  PyObject *retPtsMov = PyArray_SimpleNew(2, (npy_intp *)&dims_pts, NPY_DOUBLE);
+
+  memcpy((void *)PyArray_DATA(retMat), rm.mat.begin(),
+         (dims_mat[0] * dims_mat[1] * sizeof(double)));
+  memcpy((void *)PyArray_DATA(retPtsRef), rm.refPts.begin(),
+         (dims_pts[0] * dims_pts[1] * sizeof(double)));
+  memcpy((void *)PyArray_DATA(retPtsMov), rm.movPts.begin(),
+         (dims_pts[0] * dims_pts[1] * sizeof(double)));
+
+  /* "N" steals the references, so the arrays are owned by the tuple */
+  return Py_BuildValue("NNN", retMat, retPtsRef, retPtsMov);
+}
+
+static void preparedRefDestructor(PyObject *capsule) {
+  preparedRef *prep =
+      (preparedRef *)PyCapsule_GetPointer(capsule, PREPARED_REF_CAPSULE_NAME);
+
+  if (prep != NULL) {
+    delete prep->refImg;
+    delete prep->refMsk;
+    delete prep;
+  }
+}
+
+PyObject *turbogreg_prepare_ref(PyObject *self, PyObject *args) {
+  PyObject *ref;
+  unsigned char tf;
+
+  /* Parse the input tuple */
+  if (!PyArg_ParseTuple(args, "OB", &ref, &tf)) {
+    return NULL;
+  }
+
+  if ((tf != TRANSLATION) && (tf != RIGID_BODY) && (tf != SCALED_ROTATION) &&
+      (tf != AFFINE) && (tf != BILINEAR)) {
+    PyErr_SetString(PyExc_ValueError, "Invalid transformation");
+    return NULL;
+  }
+
+  PyObject *ref_array = PyArray_FROM_OTF(ref, NPY_DOUBLE, NPY_IN_ARRAY);
+
+  if (ref_array == NULL) {
+    return NULL;
+  }
+
+  if ((int)PyArray_NDIM(ref_array) != 2) {
+    Py_XDECREF(ref_array);
+    PyErr_SetString(PyExc_ValueError, "Input array must be two dimensional");
+    return NULL;
+  }
+
+  int Nx_ref = (int)PyArray_DIM(ref_array, 0);
+  int Ny_ref = (int)PyArray_DIM(ref_array, 1);
+
+  double *img_ref = (double *)PyArray_DATA(ref_array);
+
+  preparedRef *prep = new preparedRef();
+  prep->transformation = (Transformation)tf;
+  prep->width = Ny_ref; // width and height (Nx/Ny) have to be swapped!
+  prep->height = Nx_ref;
+
+  Py_BEGIN_ALLOW_THREADS;
+  prep->refImg = new TurboRegImage(img_ref, prep->width, prep->height,
+                                   prep->transformation, true);
+  prep->refMsk = new TurboRegMask(*prep->refImg);
+
+  prep->refMsk->clearMask();
+
+  /* frames registered against the prepared reference must have the same
+   * shape, so the pyramid depth only depends on the reference */
+  int pyramidDepth =
+      getPyramidDepth(prep->width, prep->height, prep->width, prep->height);
+  prep->refImg->setPyramidDepth(pyramidDepth);
+  prep->refMsk->setPyramidDepth(pyramidDepth);
+
+  prep->refImg->init();
+  prep->refMsk->init();
+  Py_END_ALLOW_THREADS;
+
+  Py_XDECREF(ref_array);
+
+  return PyCapsule_New(prep, PREPARED_REF_CAPSULE_NAME, preparedRefDestructor);
+}
+
+PyObject *turbogreg_register_prepared(PyObject *self, PyObject *args) {
+  PyObject *capsule, *mov;
+  regMat rm;
+
+  /* Parse the input tuple */
+  if (!PyArg_ParseTuple(args, "OO", &capsule, &mov)) {
+    return NULL;
+  }
+
+  preparedRef *prep =
+      (preparedRef *)PyCapsule_GetPointer(capsule, PREPARED_REF_CAPSULE_NAME);
+
+  if (prep == NULL) {
+    return NULL;
+  }
+
+  PyObject *mov_array = PyArray_FROM_OTF(mov, NPY_DOUBLE, NPY_IN_ARRAY);
+
+  if (mov_array == NULL) {
+    return NULL;
+  }
+
+  if ((int)PyArray_NDIM(mov_array) != 2) {
+    Py_XDECREF(mov_array);
+    PyErr_SetString(PyExc_ValueError, "Input array must be two dimensional");
+    return NULL;
+  }
+
+  int Nx_mov = (int)PyArray_DIM(mov_array, 0);
+  int Ny_mov = (int)PyArray_DIM(mov_array, 1);
+
+  if (Nx_mov != prep->height || Ny_mov != prep->width) {
+    Py_XDECREF(mov_array);
+    PyErr_SetString(PyExc_ValueError,
+                    "Input array must have the same shape as the prepared "
+                    "reference image");
+    return NULL;
+  }
+
+  double *img_mov = (double *)PyArray_DATA(mov_array);
+
+  /* registerImgPrepared does not touch any Python objects, so the GIL can
+   * be released to allow registering several frames concurrently. */
+  Py_BEGIN_ALLOW_THREADS;
+  registerImgPrepared(prep, img_mov, rm);
+  Py_END_ALLOW_THREADS;
+
+  Py_XDECREF(mov_array);
+
+  return regMatToPyTuple(rm);
+}
+
 PyObject *turbogreg_register(PyObject *self, PyObject *args) {
   PyObject *ref, *mov;
   regMat rm;
@@ -184,33 +381,18 @@ PyObject *turbogreg_register(PyObject *self, PyObject *args) {
   double *img_ref = (double *)PyArray_DATA(ref_array);
   double *img_mov = (double *)PyArray_DATA(mov_array);
 
+  /* registerImg does not touch any Python objects, so the GIL can be
+   * released to allow registering several frames concurrently. */
+  Py_BEGIN_ALLOW_THREADS;
   registerImg(img_ref, img_mov, (Transformation)tf, Ny_ref, Nx_ref,
               rm); // width and height (Nx/Ny) have to be swapped!
+  Py_END_ALLOW_THREADS;
 
   /* clean up */
   Py_XDECREF(ref_array);
   Py_XDECREF(mov_array);
 
-  npy_intp dims_mat[2];
-  npy_intp dims_pts[2];
-
-  dims_mat[0] = rm.mat.nrows();
-  dims_mat[1] = rm.mat.ncols();
-  dims_pts[0] = rm.refPts.nrows();
-  dims_pts[1] = rm.refPts.ncols();
-
-  PyObject *retMat = PyArray_SimpleNew(2, (npy_intp *)&dims_mat, NPY_DOUBLE);
-  PyObject *retPtsRef = PyArray_SimpleNew(2, (npy_intp *)&dims_pts, NPY_DOUBLE);
-  PyObject *retPtsMov = PyArray_SimpleNew(2, (npy_intp *)&dims_pts, NPY_DOUBLE);
-
-  memcpy((void *)PyArray_DATA(retMat), rm.mat.begin(),
-         (dims_mat[0] * dims_mat[1] * sizeof(double)));
-  memcpy((void *)PyArray_DATA(retPtsRef), rm.refPts.begin(),
-         (dims_pts[0] * dims_pts[1] * sizeof(double)));
-  memcpy((void *)PyArray_DATA(retPtsMov), rm.movPts.begin(),
-         (dims_pts[0] * dims_pts[1] * sizeof(double)));
-
-  return Py_BuildValue("OOO", retMat, retPtsRef, retPtsMov);
+  return regMatToPyTuple(rm);
 }
 
 PyObject *turbogreg_transform(PyObject *self, PyObject *args) {
@@ -265,9 +447,13 @@ PyObject *turbogreg_transform(PyObject *self, PyObject *args) {
   matrix<double> m(Nx_mat, Ny_mat);
   memcpy(m.begin(), tmat, (Nx_mat * Ny_mat * sizeof(double)));
 
-  std::vector<double> imgout =
-      transformImg(m, img_mov, Ny_mov,
-                   Nx_mov); // width and height (Nx/Ny) have to be swapped!
+  /* transformImg does not touch any Python objects, so the GIL can be
+   * released to allow transforming several frames concurrently. */
+  std::vector<double> imgout;
+  Py_BEGIN_ALLOW_THREADS;
+  imgout = transformImg(m, img_mov, Ny_mov,
+                        Nx_mov); // width and height (Nx/Ny) have to be swapped!
+  Py_END_ALLOW_THREADS;
 
   /* clean up */
   Py_XDECREF(mat_array);
@@ -107,6 +107,69 @@ def test_registration_transformation(stack, stack_unregistered):
     )
 
 
+def test_transform_stack_invalid_backend(stack_unregistered):
+    sr = StackReg(StackReg.TRANSLATION)
+    sr.register_stack(stack_unregistered, suppress_axis_warning=True)
+
+    with pytest.raises(ValueError):
+        sr.transform_stack(stack_unregistered, backend="gpu")
+
+
+def test_transform_stack_cuda_bilinear_unsupported(stack_unregistered):
+    sr = StackReg(StackReg.BILINEAR)
+    sr.register_stack(stack_unregistered, reference="first", suppress_axis_warning=True)
+
+    with pytest.raises(Exception, match="[Bb]ilinear"):
+        sr.transform_stack(stack_unregistered, backend="cuda")
+
+
+def test_transform_stack_cuda_without_cupy(stack_unregistered):
+    try:
+        import cupy  # noqa: F401
+    except ImportError:
+        pass
+    else:
+        pytest.skip("CuPy is installed")
+
+    sr = StackReg(StackReg.TRANSLATION)
+    sr.register_stack(stack_unregistered, suppress_axis_warning=True)
+
+    with pytest.raises(ImportError):
+        sr.transform_stack(stack_unregistered, backend="cuda")
+
+
+@pytest.mark.parametrize("reference", ["first", "previous"])
+def test_similarity_threshold_skips_duplicate_frames(stack_unregistered, reference):
+    # duplicating every frame makes each odd frame identical to its
+    # predecessor, so it must reuse the predecessor's transformation
+    stack = np.repeat(stack_unregistered, 2, axis=0)
+
+    sr = StackReg(StackReg.RIGID_BODY)
+    tmats = sr.register_stack(
+        stack,
+        reference=reference,
+        suppress_axis_warning=True,
+        similarity_threshold=1e-6,
+    )
+
+    for i in range(1, stack.shape[0], 2):
+        np.testing.assert_array_equal(tmats[i], tmats[i - 1])
+
+
+@pytest.mark.parametrize(
+    "dtype,expected_dtype",
+    [(np.float32, np.float32), (np.float64, np.float64), (np.uint16, np.float64)],
+)
+def test_transform_stack_dtype(stack_unregistered, dtype, expected_dtype):
+    stack_unregistered = stack_unregistered.astype(dtype)
+
+    sr = StackReg(StackReg.RIGID_BODY)
+    sr.register_stack(stack_unregistered, suppress_axis_warning=True)
+    out = sr.transform_stack(stack_unregistered)
+
+    assert out.dtype == expected_dtype
+
+
 @pytest.mark.parametrize("frame_axis", [1, 2])
 def test_different_axis(stack, stack_unregistered, frame_axis):
     stack["registered"] = np.moveaxis(stack["registered"], 0, frame_axis)